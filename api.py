@@ -7,9 +7,11 @@ Columnas reales en la BD:
   AMBITO_NOMBRE   → cuenca hidrográfica
   EMBALSE_NOMBRE  → nombre del embalse
   fecha           → fecha del dato (YYYY-MM-DD)
-  volumen_hm3     → volumen almacenado en hm³ (texto con coma decimal)
-  AGUA_ACTUAL     → agua actual (numérico)
+  AGUA_TOTAL      → capacidad total en hm³ (REAL, convertido en la ingesta)
+  AGUA_ACTUAL     → agua actual en hm³ (REAL, convertido en la ingesta)
   ELECTRICO_FLAG  → 1 si tiene uso eléctrico
+  porcentaje      → AGUA_ACTUAL / AGUA_TOTAL * 100 (calculado en la ingesta)
+  electrico       → ELECTRICO_FLAG como booleano (calculado en la ingesta)
 
 Endpoints:
   GET /api/meta
@@ -21,38 +23,91 @@ Endpoints:
   GET /api/embalses/<nombre>?desde=2020-01-01&hasta=2023-12-31
 
 Iniciar:
-  python api.py
+  python api.py                     (desarrollo; FLASK_DEBUG=1 activa el modo debug)
+  gunicorn -k gthread -w 2 --threads 8 -b 0.0.0.0:5000 api:app   (produccion)
 """
 
 import sqlite3
 import os
-from flask import Flask, jsonify, request, g
+import time
+import threading
+import unicodedata
+from functools import wraps
+from flask import Flask, jsonify, request
+from flask.json.provider import JSONProvider
+from flask_compress import Compress
 from flask_cors import CORS
 
+try:
+    import orjson
+except ImportError:  # sin orjson se usa el JSON estandar de Flask
+    orjson = None
+
+
+class OrjsonProvider(JSONProvider):
+    """Proveedor JSON de Flask basado en orjson (C), varias veces mas rapido que json."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj), mimetype="application/json")
+
+
 app = Flask(__name__)
+if orjson is not None:
+    app.json = OrjsonProvider(app)
 CORS(app)
+Compress(app)  # gzip/br segun Accept-Encoding
 
 DB_PATH = os.path.join(os.path.dirname(__file__), "embalses.db")
 
+# Columnas de la BD con los nombres de la API: cada fila ya sale de SQLite
+# con el formato final (porcentaje y electrico se calculan en la ingesta).
+# El sufijo [bool] convierte electrico a True/False via PARSE_COLNAMES.
+CAMPOS_EMBALSE = (
+    "EMBALSE_NOMBRE AS nombre, AMBITO_NOMBRE AS cuenca, fecha, "
+    "AGUA_TOTAL AS capacidad_hm3, AGUA_ACTUAL AS volumen_hm3, porcentaje, "
+    'electrico AS "electrico [bool]"'
+)
+sqlite3.register_converter("bool", lambda v: v != b"0")
+
+# Campos del historico de /api/embalses/<nombre>, que se devuelve por columnas
+CAMPOS_HISTORICO = ("fecha", "capacidad_hm3", "volumen_hm3", "porcentaje", "electrico")
+
+# Los datos solo cambian cuando se ejecuta el fetch (una vez por semana)
+CACHE_TTL = 3600  # segundos
+_ULTIMA_FECHA = {"valor": None, "t": 0.0}
+
 
 # ─────────────────────────────────────────────
 # Helpers
 # ─────────────────────────────────────────────
+_local = threading.local()
+
+
 def get_db():
-    db = getattr(g, "_database", None)
+    """
+    Conexion de solo lectura persistente, una por hilo: se abre una vez y se
+    reutiliza entre peticiones (sin reabrir el fichero ni repetir los PRAGMA).
+    """
+    db = getattr(_local, "db", None)
     if db is None:
-        db = g._database = sqlite3.connect(DB_PATH)
+        db = sqlite3.connect(
+            DB_PATH, detect_types=sqlite3.PARSE_COLNAMES, check_same_thread=False
+        )
         db.row_factory = sqlite3.Row
+        db.execute("PRAGMA query_only=ON")
+        db.execute("PRAGMA mmap_size=1073741824")  # hasta 1 GB mapeado en memoria
+        db.execute("PRAGMA cache_size=-65536")     # 64 MB
+        _local.db = db
     return db
 
 
-@app.teardown_appcontext
-def close_connection(exception):
-    db = getattr(g, "_database", None)
-    if db is not None:
-        db.close()
-
-
 def query_db(sql, args=(), one=False):
     cur = get_db().execute(sql, args)
     rv = cur.fetchall()
@@ -60,34 +115,58 @@ def query_db(sql, args=(), one=False):
     return ([dict(r) for r in rv] if not one else (dict(rv[0]) if rv else None))
 
 
+def slug(texto: str) -> str:
+    """Misma normalizacion que cuenca_slug / nombre_slug en la ingesta."""
+    return unicodedata.normalize("NFKD", texto.lower()).encode("ascii", "ignore").decode("ascii")
+
+
+def cacheado(vista):
+    """
+    Cachea el cuerpo ya serializado de una respuesta 200 durante CACHE_TTL
+    segundos: los aciertos no tocan SQLite ni vuelven a generar el JSON.
+    """
+    cache = {"valor": None, "t": 0.0}
+    lock  = threading.Lock()
+
+    @wraps(vista)
+    def envoltura(*args, **kwargs):
+        with lock:
+            if cache["valor"] is None or time.monotonic() - cache["t"] > CACHE_TTL:
+                resp = app.make_response(vista(*args, **kwargs))
+                if resp.status_code != 200:
+                    return resp
+                cache["valor"] = resp.get_data()
+                cache["t"]     = time.monotonic()
+        return app.response_class(cache["valor"], mimetype="application/json")
+
+    return envoltura
+
+
 def db_existe():
     return os.path.exists(DB_PATH)
 
 
-def limpiar_numero(valor):
-    """Convierte '91,00' o '91.00' o None a float."""
-    if valor is None:
-        return None
-    try:
-        return float(str(valor).replace(",", "."))
-    except Exception:
-        return None
-
-
-def formato_embalse(row: dict) -> dict:
-    """Convierte una fila raw de la BD a un dict limpio para la API."""
-    total  = limpiar_numero(row.get("AGUA_TOTAL"))
-    actual = limpiar_numero(row.get("AGUA_ACTUAL"))
-    pct    = round((actual / total * 100), 1) if total and actual and total > 0 else None
-    return {
-        "nombre":          row.get("EMBALSE_NOMBRE"),
-        "cuenca":          row.get("AMBITO_NOMBRE"),
-        "fecha":           row.get("fecha"),
-        "capacidad_hm3":   total,
-        "volumen_hm3":     actual,
-        "porcentaje":      pct,
-        "electrico":       bool(row.get("ELECTRICO_FLAG")),
-    }
+def db_actualizada():
+    """
+    La BD tiene el esquema de la ingesta actual (embalses_ultimo, porcentaje,
+    electrico). Una embalses.db anterior solo sirve para meta/cuencas/resumen.
+    """
+    return query_db(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'embalses_ultimo'", one=True
+    ) is not None
+
+
+def get_ultima_fecha():
+    """Fecha del dato mas reciente, leida de la tabla meta y cacheada CACHE_TTL segundos."""
+    ahora = time.monotonic()
+    if _ULTIMA_FECHA["valor"] is None or ahora - _ULTIMA_FECHA["t"] > CACHE_TTL:
+        r = query_db("SELECT valor FROM meta WHERE clave = 'ultima_fecha'", one=True)
+        if r is None:
+            # BD generada antes de guardar ultima_fecha en meta
+            r = query_db("SELECT MAX(fecha) AS valor FROM embalses", one=True)
+        _ULTIMA_FECHA["valor"] = r["valor"]
+        _ULTIMA_FECHA["t"] = ahora
+    return _ULTIMA_FECHA["valor"]
 
 
 # ─────────────────────────────────────────────
@@ -95,6 +174,7 @@ def formato_embalse(row: dict) -> dict:
 # ─────────────────────────────────────────────
 
 @app.route("/api/meta")
+@cacheado
 def meta():
     """Info de la ultima actualizacion."""
     if not db_existe():
@@ -104,6 +184,7 @@ def meta():
 
 
 @app.route("/api/cuencas")
+@cacheado
 def cuencas():
     """Lista de cuencas hidrograficas."""
     if not db_existe():
@@ -121,14 +202,15 @@ def resumen():
     if not db_existe():
         return jsonify({"error": "Base de datos no encontrada"}), 503
 
-    ultima_fecha = query_db(
-        "SELECT MAX(fecha) as f FROM embalses", one=True
-    )["f"]
+    ultima_fecha = get_ultima_fecha()
 
+    # embalses_ultimo (una fila por embalse) basta para contar los de ultima_fecha;
+    # una BD anterior a la ingesta actual no la tiene y se cuenta sobre embalses
+    tabla = "embalses_ultimo" if db_actualizada() else "embalses"
     r = query_db(
         "SELECT COUNT(DISTINCT EMBALSE_NOMBRE) AS total_embalses, "
         "COUNT(DISTINCT AMBITO_NOMBRE) AS total_cuencas "
-        "FROM embalses WHERE fecha = ?",
+        f"FROM {tabla} WHERE fecha = ?",
         [ultima_fecha], one=True
     )
 
@@ -145,37 +227,56 @@ def embalses_lista():
     Embalses con el dato mas reciente disponible.
 
     Query params:
-      cuenca   -> filtrar por cuenca (ej: ?cuenca=Tajo)
-      page     -> pagina (default: 1)
+      cuenca   -> filtrar por cuenca, sin distinguir mayusculas ni acentos (ej: ?cuenca=Tajo)
+      after    -> cursor: nombre del ultimo embalse recibido (ej: ?after=Alarcón)
+      page     -> pagina (default: 1; solo si no se usa after)
       per_page -> resultados por pagina (default: 50, max: 200)
     """
     if not db_existe():
         return jsonify({"error": "Base de datos no encontrada"}), 503
+    if not db_actualizada():
+        return jsonify({"error": "Base de datos con formato antiguo. Vuelve a ejecutar fetch_embalses.py"}), 503
 
     cuenca   = request.args.get("cuenca")
+    after    = request.args.get("after")
     page     = max(1, request.args.get("page", 1, type=int))
     per_page = min(200, max(1, request.args.get("per_page", 50, type=int)))
 
-    ultima_fecha = query_db("SELECT MAX(fecha) as f FROM embalses", one=True)["f"]
+    ultima_fecha = get_ultima_fecha()
 
+    # embalses_ultimo se materializa en la ingesta: una fila por embalse con su
+    # ultimo dato. Solo se sirven los que tienen dato en ultima_fecha (los que
+    # dejaron de medirse hace años no entran), igual que resumen y embalses.json
     conditions = ["fecha = ?"]
     params     = [ultima_fecha]
 
     if cuenca:
-        conditions.append("AMBITO_NOMBRE LIKE ?")
-        params.append(f"%{cuenca}%")
+        conditions.append("cuenca_slug = ?")
+        params.append(slug(cuenca))
 
     where = "WHERE " + " AND ".join(conditions)
 
     total = query_db(
-        f"SELECT COUNT(*) as n FROM embalses {where}", params, one=True
+        f"SELECT COUNT(*) as n FROM embalses_ultimo {where}", params, one=True
     )["n"]
 
-    offset = (page - 1) * per_page
-    rows = query_db(
-        f"SELECT * FROM embalses {where} ORDER BY EMBALSE_NOMBRE LIMIT ? OFFSET ?",
-        params + [per_page, offset],
-    )
+    # Paginacion por cursor (keyset): el indice sobre EMBALSE_NOMBRE permite
+    # saltar directamente al cursor. OFFSET se mantiene para ?page=N (N > 1).
+    if after is not None or page == 1:
+        page = 1 if after is None else None
+        where_cursor = "WHERE " + " AND ".join(conditions + ["EMBALSE_NOMBRE > ?"])
+        rows = query_db(
+            f"SELECT {CAMPOS_EMBALSE} FROM embalses_ultimo {where_cursor} "
+            "ORDER BY EMBALSE_NOMBRE LIMIT ?",
+            params + [after or "", per_page],
+        )
+    else:
+        offset = (page - 1) * per_page
+        rows = query_db(
+            f"SELECT {CAMPOS_EMBALSE} FROM embalses_ultimo {where} "
+            "ORDER BY EMBALSE_NOMBRE LIMIT ? OFFSET ?",
+            params + [per_page, offset],
+        )
 
     return jsonify({
         "ultima_fecha": ultima_fecha,
@@ -183,14 +284,17 @@ def embalses_lista():
         "page":         page,
         "per_page":     per_page,
         "pages":        (total + per_page - 1) // per_page,
-        "data":         [formato_embalse(r) for r in rows],
+        "next_cursor":  rows[-1]["nombre"] if len(rows) == per_page else None,
+        "data":         rows,
     })
 
 
 @app.route("/api/embalses/<string:nombre>")
 def embalse_detalle(nombre):
     """
-    Historico completo de un embalse.
+    Historico completo de un embalse (nombre exacto, sin distinguir
+    mayusculas ni acentos), con el historico por columnas:
+      {"fecha": [...], "capacidad_hm3": [...], "volumen_hm3": [...], ...}
 
     Query params:
       desde -> fecha inicio (ej: ?desde=2020-01-01)
@@ -198,12 +302,18 @@ def embalse_detalle(nombre):
     """
     if not db_existe():
         return jsonify({"error": "Base de datos no encontrada"}), 503
+    if not db_actualizada():
+        return jsonify({"error": "Base de datos con formato antiguo. Vuelve a ejecutar fetch_embalses.py"}), 503
 
     desde = request.args.get("desde")
     hasta = request.args.get("hasta")
 
-    conditions = ["EMBALSE_NOMBRE LIKE ?"]
-    params     = [f"%{nombre}%"]
+    # nombre_slug solo esta en embalses_ultimo (una fila por embalse); el
+    # historico se busca despues por EMBALSE_NOMBRE con idx_nombre_fecha
+    conditions = [
+        "EMBALSE_NOMBRE = (SELECT EMBALSE_NOMBRE FROM embalses_ultimo WHERE nombre_slug = ?)"
+    ]
+    params     = [slug(nombre)]
 
     if desde:
         conditions.append("fecha >= ?")
@@ -214,7 +324,7 @@ def embalse_detalle(nombre):
 
     where     = "WHERE " + " AND ".join(conditions)
     historico = query_db(
-        f"SELECT * FROM embalses {where} ORDER BY fecha DESC", params
+        f"SELECT {CAMPOS_EMBALSE} FROM embalses {where} ORDER BY fecha DESC", params
     )
 
     if not historico:
@@ -222,10 +332,11 @@ def embalse_detalle(nombre):
 
     ultimo = historico[0]
     return jsonify({
-        "nombre":      ultimo.get("EMBALSE_NOMBRE"),
-        "cuenca":      ultimo.get("AMBITO_NOMBRE"),
-        "ultimo_dato": formato_embalse(ultimo),
-        "historico":   [formato_embalse(r) for r in historico],
+        "nombre":      ultimo["nombre"],
+        "cuenca":      ultimo["cuenca"],
+        "ultimo_dato": ultimo,
+        # Por columnas (una lista por campo): nombre y cuenca no se repiten en cada fila
+        "historico":   {campo: [r[campo] for r in historico] for campo in CAMPOS_HISTORICO},
     })
 
 
@@ -243,4 +354,4 @@ if __name__ == "__main__":
     print("  http://localhost:5000/api/embalses?cuenca=Tajo")
     print("  http://localhost:5000/api/embalses/Albarellos")
     print("--------------------------\n")
-    app.run(debug=True, port=5000)
+    app.run(debug=os.environ.get("FLASK_DEBUG") == "1", port=5000)
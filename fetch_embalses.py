@@ -11,14 +11,16 @@ El MITECO actualiza el fichero BD-Embalses_1988-XXXX.zip cada martes.
 """
 
 import os
-import io
+import re
+import html
 import zipfile
+import tempfile
 import sqlite3
+import unicodedata
 import logging
 import requests
 import pandas as pd
 from datetime import datetime
-from bs4 import BeautifulSoup
 
 # ─────────────────────────────────────────────
 # Configuración
@@ -32,6 +34,8 @@ ZIP_DIRECT_URL = (
     "https://www.miteco.gob.es/content/dam/miteco/es/agua/temas/"
     "evaluacion-de-los-recursos-hidricos/BD-Embalses_1988-2022.zip"
 )
+# Enlace al ZIP dentro del HTML (basta una búsqueda de bytes, sin parsear el DOM)
+ZIP_HREF_RE = re.compile(rb'href=["\']([^"\']*BD-Embalses[^"\']*\.zip)["\']', re.I)
 
 DB_PATH = os.path.join(os.path.dirname(__file__), "embalses.db")
 LOG_PATH = os.path.join(os.path.dirname(__file__), "fetch.log")
@@ -66,13 +70,12 @@ def detectar_url_zip() -> str:
         log.info("Buscando URL del ZIP en la página del MITECO...")
         r = requests.get(MITECO_URL, headers=HEADERS, timeout=30)
         r.raise_for_status()
-        soup = BeautifulSoup(r.text, "html.parser")
-        for a in soup.find_all("a", href=True):
-            href = a["href"]
-            if "BD-Embalses" in href and href.endswith(".zip"):
-                url = href if href.startswith("http") else "https://www.miteco.gob.es" + href
-                log.info(f"URL del ZIP detectada: {url}")
-                return url
+        m = ZIP_HREF_RE.search(r.content)
+        if m:
+            href = html.unescape(m.group(1).decode())
+            url = href if href.startswith("http") else "https://www.miteco.gob.es" + href
+            log.info(f"URL del ZIP detectada: {url}")
+            return url
     except Exception as e:
         log.warning(f"No se pudo detectar la URL automáticamente: {e}")
     log.info(f"Usando URL por defecto: {ZIP_DIRECT_URL}")
@@ -82,26 +85,25 @@ def detectar_url_zip() -> str:
 # ─────────────────────────────────────────────
 # 2. Descargar el ZIP
 # ─────────────────────────────────────────────
-def descargar_zip(url: str) -> bytes:
+def descargar_zip(url: str) -> tempfile.SpooledTemporaryFile:
+    """Descarga el ZIP a un fichero temporal (en memoria hasta 128 MB, después a disco)."""
     log.info(f"Descargando ZIP desde: {url}")
     r = requests.get(url, headers=HEADERS, timeout=120, stream=True)
     r.raise_for_status()
-    total = int(r.headers.get("content-length", 0))
-    data = b""
+    zip_file = tempfile.SpooledTemporaryFile(max_size=128 * 1024 * 1024)
     for chunk in r.iter_content(chunk_size=65536):
-        data += chunk
-    log.info(f"ZIP descargado: {len(data)/1024/1024:.1f} MB")
-    return data
+        zip_file.write(chunk)
+    log.info(f"ZIP descargado: {zip_file.tell()/1024/1024:.1f} MB")
+    zip_file.seek(0)
+    return zip_file
 
 
 # ─────────────────────────────────────────────
 # 3. Extraer fichero del ZIP y parsear
 # ─────────────────────────────────────────────
-def parsear_excel(zip_bytes: bytes) -> pd.DataFrame:
+def parsear_excel(zip_file) -> pd.DataFrame:
     log.info("Extrayendo fichero del ZIP...")
-    import tempfile
-
-    with zipfile.ZipFile(io.BytesIO(zip_bytes)) as zf:
+    with zipfile.ZipFile(zip_file) as zf:
         nombres = zf.namelist()
         log.info(f"Ficheros en el ZIP: {nombres}")
 
@@ -111,7 +113,7 @@ def parsear_excel(zip_bytes: bytes) -> pd.DataFrame:
             excel_name = excel_files[0]
             log.info(f"Leyendo Excel: {excel_name}")
             with zf.open(excel_name) as f:
-                df = pd.read_excel(f, sheet_name=0, engine="openpyxl")
+                df = pd.read_excel(f, sheet_name=0, engine="calamine")
             log.info(f"DataFrame cargado: {len(df)} filas, columnas: {list(df.columns)}")
             return df
 
@@ -204,7 +206,6 @@ COLUMN_MAP = {
     "CAPACIDAD_TOTAL": "capacidad_hm3",
     "CAP_TOTAL":       "capacidad_hm3",
     "VOLUMEN":         "volumen_hm3",
-    "AGUA_TOTAL":      "volumen_hm3",
     "ELEC_CAPACIDAD":  "energia_mwh",
     "FECHA":           "fecha",
     "ANO":             "anio",
@@ -214,12 +215,38 @@ COLUMN_MAP = {
     "PORC":            "porcentaje",
 }
 
+# Columnas numéricas (el MITECO usa coma decimal: "91,00")
+COLUMNAS_NUMERICAS = [
+    "AGUA_TOTAL", "AGUA_ACTUAL", "capacidad_hm3", "volumen_hm3", "energia_mwh", "porcentaje",
+]
+
+
+def slug(texto):
+    """Minúsculas y sin acentos, para buscar por igualdad usando un índice."""
+    if texto is None:
+        return None
+    return unicodedata.normalize("NFKD", texto.lower()).encode("ascii", "ignore").decode("ascii")
+
 
 def normalizar(df: pd.DataFrame) -> pd.DataFrame:
     # Pasar columnas a mayúsculas para mapear sin problema de case
     df.columns = [c.strip().upper().replace(" ", "_") for c in df.columns]
     df.rename(columns={k: v for k, v in COLUMN_MAP.items() if k in df.columns}, inplace=True)
 
+    # Números con coma decimal → float, una sola vez aquí en lugar de en cada petición
+    for col in COLUMNAS_NUMERICAS:
+        if col in df.columns:
+            df[col] = pd.to_numeric(
+                df[col].astype(str).str.replace(",", ".", regex=False), errors="coerce"
+            )
+
+    # Porcentaje de llenado y uso eléctrico precalculados (la API solo los lee)
+    if "AGUA_ACTUAL" in df.columns and "AGUA_TOTAL" in df.columns:
+        total = df["AGUA_TOTAL"].where(df["AGUA_TOTAL"] > 0)
+        df["porcentaje"] = (df["AGUA_ACTUAL"] / total * 100).round(1)
+    if "ELECTRICO_FLAG" in df.columns:
+        df["electrico"] = df["ELECTRICO_FLAG"].fillna(0).astype(bool)
+
     # Calcular porcentaje si no existe
     if "porcentaje" not in df.columns and "volumen_hm3" in df.columns and "capacidad_hm3" in df.columns:
         df["porcentaje"] = (df["volumen_hm3"] / df["capacidad_hm3"] * 100).round(2)
@@ -238,22 +265,44 @@ def normalizar(df: pd.DataFrame) -> pd.DataFrame:
 def guardar_db(df: pd.DataFrame, db_path: str = DB_PATH):
     log.info(f"Guardando en base de datos: {db_path}")
     con = sqlite3.connect(db_path)
-    # Guardamos la tabla completa (histórico) reemplazando la anterior
-    df.to_sql("embalses", con, if_exists="replace", index=False)
-
-    # Vista con los datos más recientes por embalse
-    con.execute("DROP VIEW IF EXISTS embalses_ultimo")
-    if "fecha" in df.columns and "nombre" in df.columns:
+    # Carga masiva: sin fsync ni journal en disco (se restauran al final)
+    con.execute("PRAGMA synchronous=OFF")
+    con.execute("PRAGMA journal_mode=MEMORY")
+    # Páginas de 8 KB (en BD ya existentes se aplica con el VACUUM final)
+    con.execute("PRAGMA page_size=8192")
+    # Guardamos la tabla completa (histórico) reemplazando la anterior,
+    # con INSERTs de varias filas (máx. 32766 parámetros por sentencia en SQLite)
+    df.to_sql("embalses", con, if_exists="replace", index=False,
+              method="multi", chunksize=min(5000, 32766 // len(df.columns)))
+
+    # Índice para el histórico por embalse (las consultas por fecha van a
+    # embalses_ultimo, que es pequeña: un índice por fecha solo engordaría la BD)
+    if {"fecha", "EMBALSE_NOMBRE", "AMBITO_NOMBRE"} <= set(df.columns):
+        con.execute("CREATE INDEX idx_nombre_fecha ON embalses(EMBALSE_NOMBRE, fecha DESC)")
+
+    # Tabla con los datos más recientes por embalse (calculada una vez por ingesta),
+    # con cuenca y nombre normalizados para filtrar con "=" en lugar de LIKE.
+    # Versiones anteriores la creaban como vista.
+    con.create_function("slug", 1, slug, deterministic=True)
+    tipo = con.execute(
+        "SELECT type FROM sqlite_master WHERE name = 'embalses_ultimo'"
+    ).fetchone()
+    if tipo:
+        con.execute(f"DROP {tipo[0]} embalses_ultimo")
+    if {"fecha", "EMBALSE_NOMBRE", "AMBITO_NOMBRE"} <= set(df.columns):
         con.execute("""
-            CREATE VIEW embalses_ultimo AS
-            SELECT e.*
-            FROM embalses e
-            INNER JOIN (
-                SELECT nombre, MAX(fecha) AS max_fecha
+            CREATE TABLE embalses_ultimo AS
+            SELECT *, slug(AMBITO_NOMBRE) AS cuenca_slug, slug(EMBALSE_NOMBRE) AS nombre_slug
+            FROM embalses
+            WHERE (EMBALSE_NOMBRE, fecha) IN (
+                SELECT EMBALSE_NOMBRE, MAX(fecha)
                 FROM embalses
-                GROUP BY nombre
-            ) latest ON e.nombre = latest.nombre AND e.fecha = latest.max_fecha
+                GROUP BY EMBALSE_NOMBRE
+            )
         """)
+        con.execute("CREATE INDEX idx_ult_nombre ON embalses_ultimo(EMBALSE_NOMBRE)")
+        con.execute("CREATE INDEX idx_ult_cuenca ON embalses_ultimo(cuenca_slug)")
+        con.execute("CREATE INDEX idx_ult_slug ON embalses_ultimo(nombre_slug)")
 
     # Tabla de metadatos
     con.execute("""
@@ -270,7 +319,18 @@ def guardar_db(df: pd.DataFrame, db_path: str = DB_PATH):
         "INSERT OR REPLACE INTO meta VALUES (?, ?)",
         ("total_registros", str(len(df)))
     )
+    if "fecha" in df.columns:
+        con.execute(
+            "INSERT OR REPLACE INTO meta VALUES (?, ?)",
+            ("ultima_fecha", df["fecha"].max())
+        )
     con.commit()
+    con.execute("VACUUM")
+
+    # WAL permite lecturas concurrentes de la API mientras se escribe
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("PRAGMA synchronous=NORMAL")
+    con.execute("ANALYZE")
     con.close()
     log.info(f"✅ Base de datos actualizada con {len(df)} registros.")
 
@@ -285,8 +345,8 @@ def main():
 
     try:
         url = detectar_url_zip()
-        zip_bytes = descargar_zip(url)
-        df = parsear_excel(zip_bytes)
+        with descargar_zip(url) as zip_file:
+            df = parsear_excel(zip_file)
         df = normalizar(df)
         guardar_db(df)
         log.info("✅ Proceso completado con éxito.")
@@ -8,16 +8,18 @@ mdbtools se instala con: sudo apt-get install mdbtools
 """
 
 import os
+import re
+import html
 import io
 import zipfile
 import sqlite3
+import unicodedata
 import logging
 import subprocess
 import tempfile
 import requests
 import pandas as pd
 from datetime import datetime
-from bs4 import BeautifulSoup
 
 # ─────────────────────────────────────────────
 # Configuración
@@ -31,6 +33,8 @@ ZIP_DIRECT_URL = (
     "evaluacion-de-los-recursos-hidricos/boletin-hidrologico/"
     "Historico-de-embalses/BD-Embalses.zip"
 )
+# Enlace al ZIP dentro del HTML (basta una busqueda de bytes, sin parsear el DOM)
+ZIP_HREF_RE = re.compile(rb'href=["\']([^"\']*BD-Embalses[^"\']*\.zip)["\']', re.I)
 
 DB_PATH = os.path.join(os.path.dirname(__file__), "embalses.db")
 
@@ -53,13 +57,12 @@ def detectar_url_zip() -> str:
         log.info("Buscando URL del ZIP en la pagina del MITECO...")
         r = requests.get(MITECO_URL, headers=HEADERS, timeout=30)
         r.raise_for_status()
-        soup = BeautifulSoup(r.text, "html.parser")
-        for a in soup.find_all("a", href=True):
-            href = a["href"]
-            if "BD-Embalses" in href and href.endswith(".zip"):
-                url = href if href.startswith("http") else "https://www.miteco.gob.es" + href
-                log.info(f"URL detectada: {url}")
-                return url
+        m = ZIP_HREF_RE.search(r.content)
+        if m:
+            href = html.unescape(m.group(1).decode())
+            url = href if href.startswith("http") else "https://www.miteco.gob.es" + href
+            log.info(f"URL detectada: {url}")
+            return url
     except Exception as e:
         log.warning(f"No se pudo detectar URL: {e}")
     log.info(f"Usando URL por defecto: {ZIP_DIRECT_URL}")
@@ -69,23 +72,25 @@ def detectar_url_zip() -> str:
 # ─────────────────────────────────────────────
 # 2. Descargar el ZIP
 # ─────────────────────────────────────────────
-def descargar_zip(url: str) -> bytes:
+def descargar_zip(url: str) -> tempfile.SpooledTemporaryFile:
+    """Descarga el ZIP a un fichero temporal (en memoria hasta 128 MB, despues a disco)."""
     log.info(f"Descargando ZIP desde: {url}")
     r = requests.get(url, headers=HEADERS, timeout=120, stream=True)
     r.raise_for_status()
-    data = b""
+    zip_file = tempfile.SpooledTemporaryFile(max_size=128 * 1024 * 1024)
     for chunk in r.iter_content(chunk_size=65536):
-        data += chunk
-    log.info(f"ZIP descargado: {len(data)/1024/1024:.1f} MB")
-    return data
+        zip_file.write(chunk)
+    log.info(f"ZIP descargado: {zip_file.tell()/1024/1024:.1f} MB")
+    zip_file.seek(0)
+    return zip_file
 
 
 # ─────────────────────────────────────────────
 # 3. Extraer y parsear (Excel o MDB)
 # ─────────────────────────────────────────────
-def parsear(zip_bytes: bytes) -> pd.DataFrame:
+def parsear(zip_file) -> pd.DataFrame:
     log.info("Extrayendo fichero del ZIP...")
-    with zipfile.ZipFile(io.BytesIO(zip_bytes)) as zf:
+    with zipfile.ZipFile(zip_file) as zf:
         nombres = zf.namelist()
         log.info(f"Ficheros en el ZIP: {nombres}")
 
@@ -94,7 +99,7 @@ def parsear(zip_bytes: bytes) -> pd.DataFrame:
         if excel_files:
             log.info(f"Leyendo Excel: {excel_files[0]}")
             with zf.open(excel_files[0]) as f:
-                df = pd.read_excel(f, sheet_name=0, engine="openpyxl")
+                df = pd.read_excel(f, sheet_name=0, engine="calamine")
             return df
 
         # ── MDB con mdbtools ───────────────────────────────────────────────
@@ -151,6 +156,13 @@ def parsear_mdb_linux(mdb_path: str) -> pd.DataFrame:
 # ─────────────────────────────────────────────
 # 4. Guardar en SQLite
 # ─────────────────────────────────────────────
+def slug(texto):
+    """Minusculas y sin acentos, para buscar por igualdad usando un indice."""
+    if texto is None:
+        return None
+    return unicodedata.normalize("NFKD", texto.lower()).encode("ascii", "ignore").decode("ascii")
+
+
 def guardar_db(df: pd.DataFrame):
     log.info(f"Guardando en: {DB_PATH}")
 
@@ -161,15 +173,63 @@ def guardar_db(df: pd.DataFrame):
             df.rename(columns={col: "fecha"}, inplace=True)
             break
 
+    # Numeros con coma decimal ("91,00") -> float, para que la BD guarde REAL
+    for col in ("AGUA_TOTAL", "AGUA_ACTUAL"):
+        df[col] = pd.to_numeric(
+            df[col].astype(str).str.replace(",", ".", regex=False), errors="coerce"
+        )
+
+    # Porcentaje de llenado y uso electrico precalculados (la API solo los lee)
+    total = df["AGUA_TOTAL"].where(df["AGUA_TOTAL"] > 0)
+    df["porcentaje"] = (df["AGUA_ACTUAL"] / total * 100).round(1)
+    df["electrico"] = df["ELECTRICO_FLAG"].fillna(0).astype(bool)
+
     con = sqlite3.connect(DB_PATH)
-    df.to_sql("embalses", con, if_exists="replace", index=False)
+    # Carga masiva: sin fsync ni journal en disco (se restauran al final),
+    # con INSERTs de varias filas (max. 32766 parametros por sentencia en SQLite)
+    con.execute("PRAGMA synchronous=OFF")
+    con.execute("PRAGMA journal_mode=MEMORY")
+    # Paginas de 8 KB (en BD ya existentes se aplica con el VACUUM final)
+    con.execute("PRAGMA page_size=8192")
+    df.to_sql("embalses", con, if_exists="replace", index=False,
+              method="multi", chunksize=min(5000, 32766 // len(df.columns)))
+
+    # Indice para el historico por embalse (las consultas por fecha van a
+    # embalses_ultimo, que es pequena: un indice por fecha solo engordaria la BD)
+    con.execute("CREATE INDEX idx_nombre_fecha ON embalses(EMBALSE_NOMBRE, fecha DESC)")
+
+    # Tabla con los datos mas recientes por embalse (calculada una vez por ingesta),
+    # con cuenca y nombre normalizados para filtrar con "=" en lugar de LIKE
+    con.create_function("slug", 1, slug, deterministic=True)
+    con.execute("DROP TABLE IF EXISTS embalses_ultimo")
+    con.execute("""
+        CREATE TABLE embalses_ultimo AS
+        SELECT *, slug(AMBITO_NOMBRE) AS cuenca_slug, slug(EMBALSE_NOMBRE) AS nombre_slug
+        FROM embalses
+        WHERE (EMBALSE_NOMBRE, fecha) IN (
+            SELECT EMBALSE_NOMBRE, MAX(fecha)
+            FROM embalses
+            GROUP BY EMBALSE_NOMBRE
+        )
+    """)
+    con.execute("CREATE INDEX idx_ult_nombre ON embalses_ultimo(EMBALSE_NOMBRE)")
+    con.execute("CREATE INDEX idx_ult_cuenca ON embalses_ultimo(cuenca_slug)")
+    con.execute("CREATE INDEX idx_ult_slug ON embalses_ultimo(nombre_slug)")
 
     con.execute("CREATE TABLE IF NOT EXISTS meta (clave TEXT PRIMARY KEY, valor TEXT)")
     con.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)",
                 ("ultima_actualizacion", datetime.now().isoformat()))
     con.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)",
                 ("total_registros", str(len(df))))
+    con.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                ("ultima_fecha", df["fecha"].max()))
     con.commit()
+    con.execute("VACUUM")
+
+    # WAL permite lecturas concurrentes de la API mientras se escribe
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("PRAGMA synchronous=NORMAL")
+    con.execute("ANALYZE")
     con.close()
     log.info(f"Base de datos actualizada con {len(df)} registros.")
 
@@ -182,8 +242,8 @@ def main():
     log.info("Actualizacion de datos de embalses (GitHub Actions)")
     log.info("=" * 50)
     url = detectar_url_zip()
-    zip_bytes = descargar_zip(url)
-    df = parsear(zip_bytes)
+    with descargar_zip(url) as zip_file:
+        df = parsear(zip_file)
     guardar_db(df)
     log.info("Proceso completado con exito.")
 
@@ -9,106 +9,223 @@ Columnas reales del MITECO:
   AGUA_TOTAL     → capacidad total hm³
   AGUA_ACTUAL    → agua actual hm³
   ELECTRICO_FLAG → uso eléctrico
+  porcentaje     → % de llenado (calculado en la ingesta)
+  electrico      → ELECTRICO_FLAG como booleano (calculado en la ingesta)
+
+Uso:
+  python generar_json.py            → datos/embalses/<nombre>.json por embalse
+  python generar_json.py --ndjson   → datos/embalses_historico.ndjson + datos/index.json
 """
 
 import sqlite3
-import json
 import os
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import groupby
+from operator import itemgetter
+
+try:
+    import orjson
+except ImportError:  # sin orjson se serializa con json, más lento
+    import json
+    orjson = None
+
+# Los .br son para un host estático que sirva Content-Encoding: br; el workflow
+# no instala brotli porque raw.githubusercontent.com no los aprovecharía
+try:
+    import brotli
+except ImportError:  # sin brotli solo se generan los .json
+    brotli = None
 
 DB_PATH = os.path.join(os.path.dirname(__file__), "embalses.db")
 OUT_DIR = os.path.join(os.path.dirname(__file__), "datos")
+# Calidad 11 tarda ~100 veces más que 9 para ficheros solo un 20% más pequeños
+BROTLI_QUALITY = 9
+# Columnas leídas, en este orden: las filas llegan como tuplas (sin sqlite3.Row
+# ni dict por fila) y se indexan por posición
+COLUMNAS = "EMBALSE_NOMBRE, AMBITO_NOMBRE, fecha, AGUA_TOTAL, AGUA_ACTUAL, porcentaje, electrico"
+NOMBRE, CUENCA = 0, 1
+# Hilos del pool de escritura de históricos y grupos encolados a la vez
+HILOS_ESCRITURA = 8
+MAX_PENDIENTES = 4 * HILOS_ESCRITURA
+# Caracteres que no pueden ir en el nombre de fichero de cada histórico
+NOMBRE_SEGURO = str.maketrans({"/": "_", "\\": "_", " ": "_"})
 
 def get_con():
     con = sqlite3.connect(DB_PATH)
-    con.row_factory = sqlite3.Row
+    con.execute("PRAGMA cache_size=-65536")  # 64 MB de caché de páginas
+    con.execute("PRAGMA temp_store=MEMORY")  # ordenaciones temporales en RAM
+    con.execute("PRAGMA mmap_size=1073741824")  # hasta 1 GB mapeado en memoria
     return con
 
-def query(sql, args=()):
-    con = get_con()
-    rows = [dict(r) for r in con.execute(sql, args).fetchall()]
-    con.close()
-    return rows
-
 def limpiar_numero(valor):
+    # La ingesta ya guarda REAL: el caso habitual no pasa por str ni por try
     if valor is None:
         return None
+    if type(valor) is float:
+        return valor
+    if type(valor) is int:
+        return float(valor)
+    if isinstance(valor, str):
+        return numero_texto(valor)
+    try:
+        return float(valor)
+    except (TypeError, ValueError):
+        return None
+
+@lru_cache(maxsize=8192)
+def numero_texto(valor):
+    # Los textos tipo "123,45" se repiten mucho entre fechas de un mismo embalse
     try:
-        return float(str(valor).replace(",", "."))
-    except:
+        return float(valor.replace(",", "."))
+    except ValueError:
         return None
 
 def formato_embalse(row):
-    total  = limpiar_numero(row.get("AGUA_TOTAL"))
-    actual = limpiar_numero(row.get("AGUA_ACTUAL"))
-    pct    = round((actual / total * 100), 1) if total and actual and total > 0 else None
+    # porcentaje y electrico ya vienen calculados (vectorizados) desde la ingesta
+    nombre, cuenca, fecha, total, actual, porcentaje, electrico = row
     return {
-        "nombre":        row.get("EMBALSE_NOMBRE"),
-        "cuenca":        row.get("AMBITO_NOMBRE"),
-        "fecha":         row.get("fecha"),
-        "capacidad_hm3": total,
-        "volumen_hm3":   actual,
-        "porcentaje":    pct,
-        "electrico":     bool(row.get("ELECTRICO_FLAG")),
+        "nombre":        nombre,
+        "cuenca":        cuenca,
+        "fecha":         fecha,
+        "capacidad_hm3": limpiar_numero(total),
+        "volumen_hm3":   limpiar_numero(actual),
+        "porcentaje":    porcentaje,
+        "electrico":     bool(electrico),
     }
 
+def serializar(data):
+    # orjson produce directamente bytes UTF-8
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def escribir(path, contenido):
+    # Un único os.write sobre el descriptor, sin crear un BufferedWriter por fichero
+    # (O_BINARY para que Windows no traduzca saltos de línea en los .br)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o644)
+    try:
+        vista = memoryview(contenido)
+        while vista:
+            vista = vista[os.write(fd, vista):]
+    finally:
+        os.close(fd)
+
 def guardar(path, data):
-    os.makedirs(os.path.dirname(path), exist_ok=True)
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False)
-    print(f"  OK: {path}")
+    # Los directorios de salida se crean una sola vez al principio de main()
+    contenido = serializar(data)
+    escribir(path, contenido)
+    if brotli is not None:
+        # Copia precomprimida para servirla con Content-Encoding: br sin comprimir al vuelo
+        escribir(path + ".br", brotli.compress(contenido, quality=BROTLI_QUALITY))
+
+def datos_historico(nombre, historico, ultimo=None):
+    # ultimo: el dict ya formateado en embalses.json, que es historico[0]; se
+    # reutiliza como ultimo_dato y como primer elemento del histórico
+    if ultimo is None:
+        ultimo = formato_embalse(historico[0])
+    return {
+        "nombre":      nombre,
+        "cuenca":      historico[0][CUENCA],
+        "ultimo_dato": ultimo,
+        "historico":   [ultimo] + [formato_embalse(r) for r in historico[1:]],
+    }
 
-def main():
+def guardar_historico(nombre, historico, ultimo=None):
+    nombre_safe = nombre.translate(NOMBRE_SEGURO)
+    guardar(f"{OUT_DIR}/embalses/{nombre_safe}.json", datos_historico(nombre, historico, ultimo))
+
+def guardar_historicos(grupos):
+    """Un fichero embalses/<nombre>.json por embalse. Devuelve cuántos escribe."""
+    total = 0
+    with ThreadPoolExecutor(max_workers=HILOS_ESCRITURA) as pool:
+        # Cada fichero es independiente: se escriben en paralelo, con un máximo
+        # de MAX_PENDIENTES grupos en memoria en lugar de la tabla entera
+        pendientes = deque()
+        for grupo in grupos:
+            pendientes.append(pool.submit(guardar_historico, *grupo))
+            total += 1
+            if len(pendientes) >= MAX_PENDIENTES:
+                pendientes.popleft().result()
+        for futuro in pendientes:
+            futuro.result()
+    return total
+
+def guardar_ndjson(grupos):
+    """
+    Todos los históricos en embalses_historico.ndjson (un objeto por línea) y
+    en index.json el [offset, longitud] en bytes de cada embalse, para leerlo
+    con una petición Range. Devuelve cuántos escribe.
+    """
+    indice = {}
+    offset = 0
+    with open(f"{OUT_DIR}/embalses_historico.ndjson", "wb") as f:
+        for nombre, historico, ultimo in grupos:
+            linea = serializar(datos_historico(nombre, historico, ultimo))
+            f.write(linea)
+            f.write(b"\n")
+            indice[nombre] = [offset, len(linea)]
+            offset += len(linea) + 1
+    guardar(f"{OUT_DIR}/index.json", indice)
+    return len(indice)
+
+def main(ndjson=False):
     print("Generando JSON estáticos...")
-    os.makedirs(OUT_DIR, exist_ok=True)
-    os.makedirs(os.path.join(OUT_DIR, "embalses"), exist_ok=True)
+    if ndjson:
+        os.makedirs(OUT_DIR, exist_ok=True)
+    else:
+        os.makedirs(os.path.join(OUT_DIR, "embalses"), exist_ok=True)  # crea también OUT_DIR
+    con = get_con()  # una sola conexión para todas las consultas
 
-    ultima_fecha = query("SELECT MAX(fecha) as f FROM embalses")[0]["f"]
+    # embalses.json: sale de embalses_ultimo (último registro de cada embalse,
+    # materializado en la ingesta) en lugar de filtrar el histórico completo
+    ultima_fecha = con.execute("SELECT MAX(fecha) FROM embalses_ultimo").fetchone()[0]
     print(f"  Fecha: {ultima_fecha}")
+    embalses = [formato_embalse(r) for r in con.execute(
+        f"SELECT {COLUMNAS} FROM embalses_ultimo WHERE fecha = ? ORDER BY EMBALSE_NOMBRE", [ultima_fecha]
+    )]
+    guardar(f"{OUT_DIR}/embalses.json", embalses)
+    print(f"  Total embalses: {len(embalses)}")
 
     # resumen.json
-    r = query(
-        "SELECT COUNT(DISTINCT EMBALSE_NOMBRE) AS total_embalses, "
-        "COUNT(DISTINCT AMBITO_NOMBRE) AS total_cuencas "
-        "FROM embalses WHERE fecha = ?", [ultima_fecha]
-    )[0]
     guardar(f"{OUT_DIR}/resumen.json", {
         "ultima_fecha":   ultima_fecha,
-        "total_embalses": r["total_embalses"],
-        "total_cuencas":  r["total_cuencas"],
+        "total_embalses": len({e["nombre"] for e in embalses}),
+        "total_cuencas":  len({e["cuenca"] for e in embalses} - {None}),
     })
 
-    # cuencas.json
-    cuencas = [r["AMBITO_NOMBRE"] for r in query(
-        "SELECT DISTINCT AMBITO_NOMBRE FROM embalses "
-        "WHERE AMBITO_NOMBRE IS NOT NULL ORDER BY AMBITO_NOMBRE"
-    )]
-    guardar(f"{OUT_DIR}/cuencas.json", cuencas)
+    # Históricos: una sola pasada ordenada por embalse que se consume del
+    # cursor mientras se escribe; de ella sale también cuencas.json
+    print("  Generando históricos...")
+    ultimo_por_nombre = {e["nombre"]: e for e in embalses}
+    cuencas_set = set()
+    cur = con.execute(
+        f"SELECT {COLUMNAS} FROM embalses WHERE EMBALSE_NOMBRE IS NOT NULL "
+        "ORDER BY EMBALSE_NOMBRE, fecha DESC"
+    )
 
-    # embalses.json
-    rows = query("SELECT * FROM embalses WHERE fecha = ? ORDER BY EMBALSE_NOMBRE", [ultima_fecha])
-    embalses = [formato_embalse(r) for r in rows]
-    guardar(f"{OUT_DIR}/embalses.json", embalses)
-    print(f"  Total embalses: {len(embalses)}")
+    def grupos():
+        for nombre, grupo in groupby(cur, key=itemgetter(NOMBRE)):
+            grupo = list(grupo)
+            cuencas_set.update(r[CUENCA] for r in grupo)
+            yield nombre, grupo, ultimo_por_nombre.get(nombre)
 
-    # embalses/<nombre>.json (histórico)
-    nombres = [r["EMBALSE_NOMBRE"] for r in query(
-        "SELECT DISTINCT EMBALSE_NOMBRE FROM embalses WHERE EMBALSE_NOMBRE IS NOT NULL"
-    )]
-    print(f"  Generando históricos de {len(nombres)} embalses...")
-    for nombre in nombres:
-        historico = query(
-            "SELECT * FROM embalses WHERE EMBALSE_NOMBRE = ? ORDER BY fecha DESC", [nombre]
-        )
-        data = {
-            "nombre":      nombre,
-            "cuenca":      historico[0].get("AMBITO_NOMBRE") if historico else None,
-            "ultimo_dato": formato_embalse(historico[0]) if historico else {},
-            "historico":   [formato_embalse(r) for r in historico],
-        }
-        nombre_safe = nombre.replace("/", "_").replace("\\", "_").replace(" ", "_")
-        guardar(f"{OUT_DIR}/embalses/{nombre_safe}.json", data)
+    total = guardar_ndjson(grupos()) if ndjson else guardar_historicos(grupos())
+    cuencas_set.discard(None)
+    print(f"  Históricos generados: {total}")
+
+    # cuencas.json
+    guardar(f"{OUT_DIR}/cuencas.json", sorted(cuencas_set))
+    con.close()
 
     print("\nCompletado.")
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Genera los JSON estáticos a partir de embalses.db")
+    parser.add_argument(
+        "--ndjson", action="store_true",
+        help="históricos en un único embalses_historico.ndjson + index.json en lugar de embalses/<nombre>.json",
+    )
+    main(ndjson=parser.parse_args().ndjson)